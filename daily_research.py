@@ -1,16 +1,49 @@
 import os
 import sys
-import json
+import asyncio
+import copy
+import functools
+import heapq
 import re
+import shlex
+import signal
 import subprocess
+import tempfile
+import threading
 import logging
+import logging.handlers
 import time
 import yaml
 import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 from pathlib import Path
 from dotenv import load_dotenv
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    from yaml import CSafeLoader as _YamlLoader
+except ImportError:
+    from yaml import SafeLoader as _YamlLoader
+
+try:
+    import orjson as _json
+except ImportError:
+    import json as _json
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+try:
+    import anthropic
+except ImportError:
+    anthropic = None
+
+log = logging.getLogger(__name__)
 
 # Project root
 BASE_DIR = Path(__file__).resolve().parent
@@ -18,25 +51,60 @@ OUTPUT_DIR = BASE_DIR / "docs"
 LOGS_DIR = BASE_DIR / "logs"
 TEMPLATE_DIR = BASE_DIR / "templates"
 
+# Patterns used by parse_topics
+_SOURCE_PREFIXES = ("Source", "ソース", "出典")
+_SOURCE_RE = re.compile(r'(?:Source|ソース|出典)[:：]\s*(https?://\S+)')
+_MD_LINK_RE = re.compile(r'-?\s*\[.*?\]\(https?://.*?\)')
+_URL_IN_PARENS_RE = re.compile(r'\((https?://[^\)]+)\)')
+
+# Shared Jinja environment; the bytecode cache lets later runs skip template compilation
+_JINJA_CACHE_DIR = BASE_DIR / ".jinja_cache"
+_JINJA_CACHE_DIR.mkdir(exist_ok=True)
+_JINJA_ENV = Environment(
+    loader=FileSystemLoader(str(TEMPLATE_DIR)),
+    auto_reload=False,
+    bytecode_cache=FileSystemBytecodeCache(str(_JINJA_CACHE_DIR))
+)
+
+# Defaults for collect_backend: api
+DEFAULT_ANTHROPIC_MODEL = "claude-sonnet-4-5"
+DEFAULT_ANTHROPIC_MAX_TOKENS = 8192
+# Upper bound on requests per category when web search keeps pausing the turn
+ANTHROPIC_MAX_CONTINUATIONS = 5
+
+# Shared HTTP session; retries rate-limited and 5xx webhook responses with backoff
+_HTTP = requests.Session()
+_HTTP.mount("https://", HTTPAdapter(max_retries=Retry(
+    total=3,
+    backoff_factor=2,
+    status_forcelist=[429, 500, 502, 503, 504],
+    allowed_methods=frozenset({"POST"})
+)))
+
 
 def setup_logging(date_str):
     """Setup logging to logs/YYYY-MM-DD.log"""
     LOGS_DIR.mkdir(exist_ok=True)
     log_file = LOGS_DIR / f"{date_str}.log"
+    log_format = "%(asctime)s [%(levelname)s] %(message)s"
+    # Buffer file writes; flushed on ERROR or when logging shuts down at exit
+    file_handler = logging.FileHandler(log_file, encoding="utf-8", delay=True)
+    file_handler.setFormatter(logging.Formatter(log_format))
     logging.basicConfig(
         level=logging.INFO,
-        format="%(asctime)s [%(levelname)s] %(message)s",
+        format=log_format,
         handlers=[
-            logging.FileHandler(log_file, encoding="utf-8"),
+            logging.handlers.MemoryHandler(1000, flushLevel=logging.ERROR, target=file_handler),
             logging.StreamHandler()
         ]
     )
 
 
+@functools.lru_cache(maxsize=1)
 def load_config():
-    """Load config.yaml"""
+    """Load config.yaml (cached; callers must not mutate the result)"""
     with open(BASE_DIR / "config.yaml", encoding="utf-8") as f:
-        return yaml.safe_load(f)
+        return yaml.load(f, Loader=_YamlLoader)
 
 
 def already_generated_today(date_str):
@@ -44,10 +112,22 @@ def already_generated_today(date_str):
     return (OUTPUT_DIR / f"{date_str}.html").exists()
 
 
-def collect_category(category_key, category_config, topics_count, timeout):
-    """Collect info for one category via claude CLI with WebSearch"""
-    today = datetime.now().strftime("%Y-%m-%d")
-    prompt = f"""今日は{today}です。{category_config['query']}について最新の情報を{topics_count}件調査してください。
+def _require_anthropic():
+    """Fail early when collect_backend is 'api' but the SDK is missing"""
+    if anthropic is None:
+        raise RuntimeError("collect_backend 'api' requires the anthropic package")
+
+
+@functools.lru_cache(maxsize=1)
+def _anthropic_client():
+    """Create the Anthropic API client once (reads ANTHROPIC_API_KEY)"""
+    _require_anthropic()
+    return anthropic.Anthropic()
+
+
+def _build_prompt(today, category_config, topics_count):
+    """Build the research prompt for one category"""
+    return f"""今日は{today}です。{category_config['query']}について最新の情報を{topics_count}件調査してください。
 日本語・英語両方のソースから収集し、日本語でまとめてください。
 
 以下のフォーマットで出力してください（各トピックを---で区切る）:
@@ -62,173 +142,409 @@ Source: URL
 サマリー
 Source: URL
 """
-    logging.info(f"Collecting {category_key}...")
 
-    result = subprocess.run(
-        ['claude', '-p', prompt, '--allowedTools', 'WebSearch', '--output-format', 'json'],
-        capture_output=True, text=True, encoding='utf-8', timeout=timeout, cwd=str(BASE_DIR)
-    )
 
-    if result.returncode != 0:
-        raise RuntimeError(f"claude CLI failed: {result.stderr}")
+def _read_cli_result(stream):
+    """Pull the "result" field out of claude CLI JSON output on a binary stream"""
+    if ijson is None:
+        output = _json.loads(stream.read())
+        result = output.get("result") if isinstance(output, dict) else None
+    else:
+        result = next(ijson.items(stream, "result"), None)
+        # Drain the rest so the CLI never blocks on a full pipe
+        while stream.read(65536):
+            pass
+    if not isinstance(result, str):
+        raise ValueError('claude CLI output has no "result" string')
+    return result
+
 
-    output = json.loads(result.stdout)
-    return output.get("result", "")
+def _cli_failed(stderr):
+    """Error for a non-zero claude CLI exit, carrying its captured stderr"""
+    stderr.seek(0)
+    return RuntimeError(f"claude CLI failed: {stderr.read().decode('utf-8', 'replace')}")
+
+
+def _kill_process_group(proc):
+    """SIGKILL the CLI and everything it spawned (it runs in its own session)"""
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def _collect_via_cli(prompt, timeout):
+    """Run the prompt through claude CLI with WebSearch, parsing stdout as it streams"""
+    cmd = ['claude', '-p', prompt, '--allowedTools', 'WebSearch', '--output-format', 'json']
+    timed_out = threading.Event()
+
+    def kill():
+        # Kill the whole process group; children holding stdout would keep the read blocked
+        if proc.poll() is not None:
+            return  # Finished just as the timer fired; not a timeout
+        timed_out.set()
+        _kill_process_group(proc)
+
+    # stderr goes to a temp file so an unread pipe can't stall the CLI
+    with tempfile.TemporaryFile() as stderr:
+        with subprocess.Popen(
+            cmd, stdout=subprocess.PIPE, stderr=stderr, cwd=str(BASE_DIR), start_new_session=True
+        ) as proc:
+            timer = threading.Timer(timeout, kill)
+            timer.start()
+            try:
+                result = _read_cli_result(proc.stdout)
+            except BaseException as e:
+                # Stop the CLI now (bad output, Ctrl+C) instead of waiting for the timer
+                timer.cancel()
+                if proc.poll() is None:
+                    _kill_process_group(proc)
+                proc.wait()
+                if timed_out.is_set():
+                    raise subprocess.TimeoutExpired(cmd, timeout) from e
+                # A CLI that exited with an error on its own explains the bad output better
+                if isinstance(e, Exception) and proc.returncode > 0:
+                    raise _cli_failed(stderr) from e
+                raise
+            finally:
+                proc.wait()
+                timer.cancel()
+
+        if timed_out.is_set():
+            raise subprocess.TimeoutExpired(cmd, timeout)
+        if proc.returncode != 0:
+            raise _cli_failed(stderr)
+    return result
+
+
+def _api_request(prompt, config):
+    """Keyword arguments for messages.create with the web search tool"""
+    return {
+        "model": config.get("anthropic_model", DEFAULT_ANTHROPIC_MODEL),
+        "max_tokens": config.get("anthropic_max_tokens", DEFAULT_ANTHROPIC_MAX_TOKENS),
+        "tools": [{"type": "web_search_20250305", "name": "web_search"}],
+        "messages": [{"role": "user", "content": prompt}],
+        "timeout": config["claude_timeout_sec"]
+    }
+
+
+def _response_text(resp):
+    """Web search interleaves tool blocks with text; keep only the text"""
+    return "".join(block.text for block in resp.content if block.type == "text")
+
+
+def _next_api_request(request, resp):
+    """Request that continues a paused turn, or None once the response is complete"""
+    if resp.stop_reason == "max_tokens":
+        raise RuntimeError("Anthropic API response was cut off at max_tokens (raise anthropic_max_tokens)")
+    if resp.stop_reason != "pause_turn":
+        return None
+
+    # Send the paused assistant content back so the server resumes the same turn
+    messages = request["messages"]
+    content = list(resp.content)
+    if messages[-1]["role"] == "assistant":
+        content = [*messages[-1]["content"], *content]
+        messages = messages[:-1]
+    return {**request, "messages": [*messages, {"role": "assistant", "content": content}]}
+
+
+def _api_turn(prompt, config):
+    """Generator driving one API turn: yields each request, is sent its response, returns the text
+
+    Shared by the sync and async backends so continuation handling stays in one place.
+    """
+    request = _api_request(prompt, config)
+    texts = []
+    for _ in range(ANTHROPIC_MAX_CONTINUATIONS):
+        resp = yield request
+        texts.append(_response_text(resp))
+        request = _next_api_request(request, resp)
+        if request is None:
+            return "".join(texts)
+    raise RuntimeError(f"Anthropic API turn still paused after {ANTHROPIC_MAX_CONTINUATIONS} requests")
+
+
+def _collect_via_api(prompt, config):
+    """Run the prompt through the Anthropic API, continuing paused turns"""
+    turn = _api_turn(prompt, config)
+    request = next(turn)
+    while True:
+        try:
+            request = turn.send(_anthropic_client().messages.create(**request))
+        except StopIteration as done:
+            return done.value
+
+
+def build_prompts(config, today):
+    """Build every category prompt up front so retries reuse the same text"""
+    return {
+        key: _build_prompt(today, cat_config, config["topics_per_category"])
+        for key, cat_config in config["categories"].items()
+    }
+
+
+def collect_category(category_key, prompt, config):
+    """Collect info for one category via claude CLI or the Anthropic API"""
+    log.info("Collecting %s...", category_key)
+
+    if config.get("collect_backend", "cli") == "api":
+        return _collect_via_api(prompt, config)
+    return _collect_via_cli(prompt, config["claude_timeout_sec"])
+
+
+async def _collect_category_async(client, semaphore, category_key, prompt, config):
+    """Async counterpart of collect_category for the API backend"""
+    async with semaphore:
+        log.info("Collecting %s...", category_key)
+        turn = _api_turn(prompt, config)
+        request = next(turn)
+        while True:
+            try:
+                request = turn.send(await client.messages.create(**request))
+            except StopIteration as done:
+                return done.value
 
 
 def parse_topics(markdown_text):
     """Parse markdown output from claude into structured topic list"""
     topics = []
+    current = None
 
-    # Split by ### headers
-    sections = re.split(r'(?=^### )', markdown_text, flags=re.MULTILINE)
+    for line in markdown_text.splitlines():
+        # Each ### header starts a new topic
+        if line.startswith("### "):
+            current = {"title": line[4:].strip(), "summary": [], "source": ""}
+            topics.append(current)
+            continue
+        if current is None:
+            continue
 
-    for section in sections:
-        section = section.strip()
-        if not section.startswith("###"):
+        line = line.strip()
+        if not line or line == "---":
             continue
+        # Look for source URL patterns (substring checks skip the regex for plain text)
+        source_match = _SOURCE_RE.match(line) if line.startswith(_SOURCE_PREFIXES) else None
+        if source_match:
+            current["source"] = source_match.group(1)
+        # Also check for markdown link format: [text](url)
+        elif "](http" in line and _MD_LINK_RE.match(line):
+            url_match = _URL_IN_PARENS_RE.search(line)
+            if url_match:
+                current["source"] = url_match.group(1)
+        else:
+            current["summary"].append(line)
+
+    return [
+        {"title": t["title"], "summary": " ".join(t["summary"]), "source": t["source"]}
+        for t in topics if t["title"]
+    ]
 
-        lines = section.split("\n")
-        title = lines[0].replace("### ", "").strip()
-
-        # Extract source URL
-        source = ""
-        summary_lines = []
-        for line in lines[1:]:
-            line = line.strip()
-            if not line or line == "---":
-                continue
-            # Look for source URL patterns
-            source_match = re.match(r'(?:Source|ソース|出典)[:：]\s*(https?://\S+)', line)
-            if source_match:
-                source = source_match.group(1)
-            # Also check for markdown link format: [text](url)
-            elif re.match(r'-?\s*\[.*?\]\(https?://.*?\)', line):
-                url_match = re.search(r'\((https?://[^\)]+)\)', line)
-                if url_match:
-                    source = url_match.group(1)
-            else:
-                summary_lines.append(line)
 
-        summary = " ".join(summary_lines).strip()
-        if title:
-            topics.append({
-                "title": title,
-                "summary": summary,
-                "source": source
-            })
+def _category_result(category_key, category_config, raw_result):
+    """Turn raw claude output into a category entry for the report"""
+    topics = parse_topics(raw_result)
+
+    if not topics:
+        # Fallback: use raw result as single topic
+        log.warning("Parse failed for %s, using raw fallback", category_key)
+        topics = [{"title": category_config["name"], "summary": raw_result[:500], "source": ""}]
+
+    log.info("Collected %d topics for %s", len(topics), category_key)
+    return {
+        "name": category_config["name"],
+        "topics": topics
+    }
+
 
-    return topics
+def collect_all(config, prompts):
+    """Collect info for all categories concurrently, using prompts from build_prompts
 
+    Returns (categories_result, total_topics).
+    """
+    if config.get("collect_backend", "cli") == "api":
+        return asyncio.run(collect_all_async(config, prompts))
 
-def collect_all(config):
-    """Collect info for all categories"""
-    categories_result = {}
+    categories = config["categories"]
+    collected = {}
+    total_topics = 0
+    first_error = None
 
-    for key, cat_config in config["categories"].items():
+    max_workers = config.get("collect_concurrency", len(categories)) or 1
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(collect_category, key, prompts[key], config): key
+            for key in categories
+        }
+
+        for future in as_completed(futures):
+            key = futures[future]
+            try:
+                collected[key] = _category_result(key, categories[key], future.result())
+                total_topics += len(collected[key]["topics"])
+            except Exception as e:
+                log.error("Failed to collect %s: %s", key, e)
+                if first_error is None:
+                    first_error = e
+
+    if first_error is not None:
+        raise first_error
+
+    # Keep the category order from config.yaml
+    return {key: collected[key] for key in categories}, total_topics
+
+
+async def collect_all_async(config, prompts):
+    """Collect info for all categories on one event loop (API backend); same return as collect_all"""
+    _require_anthropic()
+    categories = config["categories"]
+    collected = {}
+    total_topics = 0
+    first_error = None
+
+    semaphore = asyncio.Semaphore(config.get("collect_concurrency", len(categories)) or 1)
+    async with anthropic.AsyncAnthropic() as client:
+        raw_results = await asyncio.gather(
+            *(_collect_category_async(client, semaphore, key, prompts[key], config)
+              for key in categories),
+            return_exceptions=True
+        )
+
+    for (key, cat_config), raw_result in zip(categories.items(), raw_results):
         try:
-            raw_result = collect_category(
-                key, cat_config,
-                config["topics_per_category"],
-                config["claude_timeout_sec"]
-            )
-            topics = parse_topics(raw_result)
-
-            if not topics:
-                # Fallback: use raw result as single topic
-                logging.warning(f"Parse failed for {key}, using raw fallback")
-                topics = [{"title": cat_config["name"], "summary": raw_result[:500], "source": ""}]
-
-            categories_result[key] = {
-                "name": cat_config["name"],
-                "topics": topics
-            }
-            logging.info(f"Collected {len(topics)} topics for {key}")
+            if isinstance(raw_result, BaseException):
+                raise raw_result
+            collected[key] = _category_result(key, cat_config, raw_result)
+            total_topics += len(collected[key]["topics"])
         except Exception as e:
-            logging.error(f"Failed to collect {key}: {e}")
-            raise
+            log.error("Failed to collect %s: %s", key, e)
+            if first_error is None:
+                first_error = e
 
-    return categories_result
+    if first_error is not None:
+        raise first_error
 
+    return collected, total_topics
 
-def generate_report_html(date_str, generated_at, categories):
-    """Generate daily report HTML from template"""
-    OUTPUT_DIR.mkdir(exist_ok=True)
-    env = Environment(loader=FileSystemLoader(str(TEMPLATE_DIR)))
-    template = env.get_template("report.html")
-    html = template.render(
+
+def _dump_template(template, path, **context):
+    """Stream a template to a temp file, then move it onto path so a failed render leaves no partial file"""
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    try:
+        template.stream(**context).dump(str(tmp_path), encoding="utf-8")
+        os.replace(tmp_path, path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+
+def _render_report(date_str, generated_at, categories):
+    """Render the daily report HTML from template"""
+    template = _JINJA_ENV.get_template("report.html")
+    output_path = OUTPUT_DIR / f"{date_str}.html"
+    _dump_template(
+        template, output_path,
         date=date_str,
         generated_at=generated_at,
         categories=categories
     )
-    output_path = OUTPUT_DIR / f"{date_str}.html"
-    output_path.write_text(html, encoding="utf-8")
-    logging.info(f"Generated report: {output_path}")
+    log.info("Generated report: %s", output_path)
     return output_path
 
 
-def generate_index_html():
+def _report_dates():
+    """Dates of all report HTML files (YYYY-MM-DD.html pattern) in OUTPUT_DIR"""
+    dates = []
+    with os.scandir(OUTPUT_DIR) as entries:
+        for entry in entries:
+            name = entry.name
+            if (len(name) == 15 and name.endswith(".html")
+                    and name[4] == "-" and name[7] == "-"
+                    and name[:4].isdigit() and name[5:7].isdigit() and name[8:10].isdigit()):
+                dates.append(name[:10])
+    return dates
+
+
+def _render_index():
     """Regenerate index.html with list of all reports"""
-    OUTPUT_DIR.mkdir(exist_ok=True)
-    env = Environment(loader=FileSystemLoader(str(TEMPLATE_DIR)))
-    template = env.get_template("index.html")
+    template = _JINJA_ENV.get_template("index.html")
 
-    # Find all report HTML files (YYYY-MM-DD.html pattern)
-    report_files = sorted(
-        [f.stem for f in OUTPUT_DIR.glob("????-??-??.html")],
-        reverse=True
-    )[:30]  # Last 30 days
+    report_files = heapq.nlargest(30, _report_dates())  # Last 30 days (ISO dates sort chronologically)
 
     reports = [{"date": date} for date in report_files]
     latest_date = report_files[0] if report_files else None
 
-    html = template.render(latest_date=latest_date, reports=reports)
     index_path = OUTPUT_DIR / "index.html"
-    index_path.write_text(html, encoding="utf-8")
-    logging.info(f"Generated index: {index_path}")
+    _dump_template(template, index_path, latest_date=latest_date, reports=reports)
+    log.info("Generated index: %s", index_path)
+
+
+def publish(date_str, generated_at, categories):
+    """Write the daily report and the refreshed index into OUTPUT_DIR"""
+    OUTPUT_DIR.mkdir(exist_ok=True)
+    output_path = _render_report(date_str, generated_at, categories)
+    _render_index()
+    log.info("HTML generation complete")
+    return output_path
 
 
 def git_push(date_str):
     """Commit and push generated HTML to GitHub"""
     try:
-        subprocess.run(['git', 'add', 'docs/'], check=True, cwd=str(BASE_DIR), encoding='utf-8')
+        message = shlex.quote(f"Add daily report {date_str}")
         subprocess.run(
-            ['git', 'commit', '-m', f'Add daily report {date_str}'],
+            ['sh', '-c', f"git add docs/ && git commit -m {message} && git push origin master"],
             check=True, cwd=str(BASE_DIR), encoding='utf-8'
         )
-        subprocess.run(['git', 'push', 'origin', 'master'], check=True, cwd=str(BASE_DIR), encoding='utf-8')
-        logging.info(f"Pushed report {date_str} to GitHub")
+        log.info("Pushed report %s to GitHub", date_str)
     except subprocess.CalledProcessError as e:
-        logging.error(f"Git operation failed: {e}")
+        log.error("Git operation failed: %s", e)
         raise
 
 
+# Adaptive Card skeleton for notify_teams; {DATE}/{COUNT} are filled per call
+_TEAMS_CARD_TEMPLATE = {
+    "type": "message",
+    "attachments": [{
+        "contentType": "application/vnd.microsoft.card.adaptive",
+        "contentUrl": None,
+        "content": {
+            "$schema": "http://adaptivecards.io/schemas/adaptive-card.json",
+            "type": "AdaptiveCard",
+            "version": "1.4",
+            "body": [
+                {
+                    "type": "TextBlock",
+                    "text": "AI Daily Report - {DATE}",
+                    "weight": "Bolder",
+                    "size": "Medium"
+                },
+                {
+                    "type": "TextBlock",
+                    "text": "{COUNT}件のトピックを収集しました",
+                    "wrap": True,
+                    "spacing": "Small"
+                }
+            ]
+        }
+    }]
+}
+
+
 def notify_teams(date_str, topics_count, categories, config):
     """Send notification to Teams via Incoming Webhook"""
     webhook_url = os.environ.get("TEAMS_WEBHOOK_URL", "")
     if not webhook_url:
-        logging.warning("TEAMS_WEBHOOK_URL not set, skipping notification")
+        log.warning("TEAMS_WEBHOOK_URL not set, skipping notification")
         return
 
-    base_url = config.get("github_pages_base_url", "")
-    report_url = f"{base_url}/{date_str}.html" if base_url else ""
-
-    # Build body with category sections
-    body = [
-        {
-            "type": "TextBlock",
-            "text": f"AI Daily Report - {date_str}",
-            "weight": "Bolder",
-            "size": "Medium"
-        },
-        {
-            "type": "TextBlock",
-            "text": f"{topics_count}件のトピックを収集しました",
-            "wrap": True,
-            "spacing": "Small"
-        }
-    ]
+    card = copy.deepcopy(_TEAMS_CARD_TEMPLATE)
+    content = card["attachments"][0]["content"]
+    body = content["body"]
+    body[0]["text"] = body[0]["text"].format(DATE=date_str)
+    body[1]["text"] = body[1]["text"].format(COUNT=topics_count)
 
+    # Add category sections
     for cat in categories.values():
         # Category header
         body.append({
@@ -247,56 +563,40 @@ def notify_teams(date_str, topics_count, categories, config):
             "spacing": "Small"
         })
 
-    card = {
-        "type": "message",
-        "attachments": [{
-            "contentType": "application/vnd.microsoft.card.adaptive",
-            "contentUrl": None,
-            "content": {
-                "$schema": "http://adaptivecards.io/schemas/adaptive-card.json",
-                "type": "AdaptiveCard",
-                "version": "1.4",
-                "body": body
-            }
-        }]
-    }
-
     # Add link action if base URL is configured
-    if report_url:
-        card["attachments"][0]["content"]["actions"] = [{
+    base_url = config.get("github_pages_base_url", "")
+    if base_url:
+        content["actions"] = [{
             "type": "Action.OpenUrl",
             "title": "レポートを見る",
-            "url": report_url
+            "url": f"{base_url}/{date_str}.html"
         }]
 
     try:
-        resp = requests.post(webhook_url, json=card, timeout=30)
+        resp = _HTTP.post(webhook_url, json=card, timeout=30)
         resp.raise_for_status()
-        logging.info("Teams notification sent")
+        log.info("Teams notification sent")
     except Exception as e:
-        logging.error(f"Teams notification failed: {e}")
+        log.error("Teams notification failed: %s", e)
         # Don't raise - notification failure shouldn't block the pipeline
 
 
-def run_with_retry(config):
-    """Run the main pipeline with retry logic"""
-    today = datetime.now().strftime("%Y-%m-%d")
+def run_with_retry(config, today):
+    """Run the main pipeline with retry logic for the report dated today"""
     max_retries = config.get("retry_max", 3)
     interval = config.get("retry_interval_sec", 1800)
+    prompts = build_prompts(config, today)
 
     for attempt in range(1, max_retries + 1):
         try:
-            logging.info(f"Attempt {attempt}/{max_retries}")
+            log.info("Attempt %d/%d", attempt, max_retries)
 
             # Collect
-            categories = collect_all(config)
-            total_topics = sum(len(c['topics']) for c in categories.values())
+            categories, total_topics = collect_all(config, prompts)
 
             # Generate HTML
             generated_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            generate_report_html(today, generated_at, categories)
-            generate_index_html()
-            logging.info("HTML generation complete")
+            publish(today, generated_at, categories)
 
             # Git push
             git_push(today)
@@ -304,16 +604,16 @@ def run_with_retry(config):
             # Notify Teams
             notify_teams(today, total_topics, categories, config)
 
-            logging.info(f"Pipeline complete: {total_topics} topics collected and published")
+            log.info("Pipeline complete: %d topics collected and published", total_topics)
             return  # Success
 
         except Exception as e:
-            logging.error(f"Attempt {attempt} failed: {e}")
+            log.error("Attempt %d failed: %s", attempt, e)
             if attempt < max_retries:
-                logging.info(f"Retrying in {interval} seconds...")
+                log.info("Retrying in %s seconds...", interval)
                 time.sleep(interval)
             else:
-                logging.error(f"All {max_retries} attempts failed")
+                log.error("All %d attempts failed", max_retries)
                 raise
 
 
@@ -330,14 +630,15 @@ def main():
     if not test_collect and not test_html:
         # Normal mode: check for duplicate
         if already_generated_today(today):
-            logging.info(f"Report for {today} already exists. Skipping.")
+            log.info("Report for %s already exists. Skipping.", today)
             return
 
     if test_collect:
         # Test mode: collect only first category
         first_key = list(config["categories"].keys())[0]
         first_config = config["categories"][first_key]
-        raw = collect_category(first_key, first_config, config["topics_per_category"], config["claude_timeout_sec"])
+        prompt = _build_prompt(today, first_config, config["topics_per_category"])
+        raw = collect_category(first_key, prompt, config)
         topics = parse_topics(raw)
         print(f"\n=== Test Collection: {first_key} ===")
         print(f"Raw length: {len(raw)} chars")
@@ -350,19 +651,16 @@ def main():
 
     if test_html:
         # Test HTML mode: collect and generate, but skip git push / notify
-        logging.info(f"Starting collection for {today}")
-        categories = collect_all(config)
-        logging.info(f"Collection complete: {sum(len(c['topics']) for c in categories.values())} total topics")
+        log.info("Starting collection for %s", today)
+        categories, total_topics = collect_all(config, build_prompts(config, today))
+        log.info("Collection complete: %d total topics", total_topics)
         generated_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        generate_report_html(today, generated_at, categories)
-        generate_index_html()
-        logging.info("HTML generation complete")
-        output_path = OUTPUT_DIR / f"{today}.html"
+        output_path = publish(today, generated_at, categories)
         print(f"Report generated: {output_path}")
         return
 
     # Normal mode
-    run_with_retry(config)
+    run_with_retry(config, today)
 
 
 if __name__ == "__main__":